@@ -1,12 +1,20 @@
+import math
 import os
+import re
+import sys
 import smtplib
 import ssl
 import requests
 import json
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from typing import NamedTuple
 from zoneinfo import ZoneInfo
 
 # --- Cargar .env ---
@@ -16,6 +24,24 @@ try:
 except Exception:
     pass
 
+# --- Bloqueo entre ejecuciones (solo POSIX) ---
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# --- JSON rápido (orjson si está instalado) ---
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_loads(raw):
+    """Decodifica JSON desde bytes/str con orjson si está disponible."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 # --- Config ---
 API_KEY     = os.getenv("HOLDED_API_KEY")
 USE_BEARER  = os.getenv("HOLDED_USE_BEARER", "false").lower() in ("1","true","yes")
@@ -26,14 +52,29 @@ SMTP_HOST   = os.getenv("SMTP_HOST")
 SMTP_PORT   = int(os.getenv("SMTP_PORT", "587"))  # 587 STARTTLS | 465 SSL
 SMTP_USER   = os.getenv("SMTP_USER")
 SMTP_PASS   = os.getenv("SMTP_PASS")
+SEND_EMPTY  = os.getenv("SEND_EMPTY", "false").lower() in ("1","true","yes")  # enviar aunque no haya nada nuevo
 
 BASE_URL_ORDERS         = "https://api.holded.com/api/invoicing/v1/documents/salesorder"
 BASE_URL_INVOICES       = "https://api.holded.com/api/invoicing/v1/documents/invoice"
 BASE_URL_CREDIT_NOTES   = "https://api.holded.com/api/invoicing/v1/documents/creditnote"
 PAGE_LIMIT = 200
+PAGE_WORKERS = 4  # páginas pedidas en paralelo cuando un rango no cabe en una
+FETCH_WORKERS = 4  # rangos (pedidos, facturas, abonos...) descargados en paralelo en main()
+
+# Sesión HTTP compartida: reutiliza conexiones TLS con api.holded.com entre páginas y rangos
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
 
 # Archivos de estado
-STATE_FILE_INVOICES = Path(".state/processed_invoices.json")
+STATE_FILE_INVOICES = Path(".state/processed_invoices.txt")          # un id por línea
+LEGACY_STATE_FILE_INVOICES = Path(".state/processed_invoices.json")  # formato antiguo (lista JSON)
+LOCK_FILE = Path(".state/lock")
 
 # Zona horaria Madrid
 TZ_MADRID = ZoneInfo("Europe/Madrid")
@@ -69,7 +110,9 @@ def month_name_es(dt: datetime) -> str:
     except Exception:
         return ""
 
+@lru_cache(maxsize=1)
 def headers():
+    """Cabeceras de autenticación; se construyen una sola vez (si falta la API key se vuelve a comprobar)."""
     if not API_KEY:
         raise SystemExit("ERROR: falta HOLDED_API_KEY en variables de entorno")
     h = {"Accept": "application/json"}
@@ -79,15 +122,18 @@ def headers():
         h["key"] = API_KEY
     return h
 
+# Intercambia separadores en una sola pasada: 1,234.56 -> 1.234,56
+_EUR_SWAP = str.maketrans(",.", ".,")
+
 def fmt_eur(n):
     try:
         v = float(n or 0)
     except Exception:
         return str(n)
-    return f"{v:,.2f} €".replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"{v:,.2f}".translate(_EUR_SWAP) + " €"
 
-def madrid_yesterday_bounds_epoch_seconds():
-    now_mad = datetime.now(TZ_MADRID)
+def madrid_yesterday_bounds_epoch_seconds(now_mad=None):
+    now_mad = now_mad or datetime.now(TZ_MADRID)
     ayer = now_mad - timedelta(days=1)
     start_mad = datetime(ayer.year, ayer.month, ayer.day, 0, 0, 0, tzinfo=TZ_MADRID)
     end_mad   = datetime(ayer.year, ayer.month, ayer.day, 23, 59, 59, tzinfo=TZ_MADRID)
@@ -95,29 +141,70 @@ def madrid_yesterday_bounds_epoch_seconds():
     end_utc   = end_mad.astimezone(timezone.utc)
     return int(start_utc.timestamp()), int(end_utc.timestamp())
 
-def madrid_yesterday_label():
-    return (datetime.now(TZ_MADRID) - timedelta(days=1)).strftime("%d/%m/%Y")
+def madrid_yesterday_label(now_mad=None):
+    return ((now_mad or datetime.now(TZ_MADRID)) - timedelta(days=1)).strftime("%d/%m/%Y")
+
+@lru_cache(maxsize=1024)
+def _fmt_epoch(ts: int) -> str:
+    """Formatea epoch (s) en hora de Madrid. Cacheado: los documentos repiten timestamps."""
+    return datetime.fromtimestamp(ts, tz=TZ_MADRID).strftime("%Y-%m-%d %H:%M:%S")
 
 def epoch_to_local_str(s):
     """Convierte epoch (s o ms) a cadena local. Si no es epoch, devuelve str(s)."""
     try:
-        si = int(str(s))
+        # int exacto va directo; el resto como antes vía str (bool y floats quedan en crudo)
+        si = s if type(s) is int else int(str(s))
+        if si < 0:
+            return str(s)
         if si >= 10**12:  # milisegundos
-            si = si // 1000
-        return datetime.fromtimestamp(int(si), tz=timezone.utc).astimezone(TZ_MADRID).strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
+            si //= 1000
+        return _fmt_epoch(si)
+    except (AttributeError, TypeError, ValueError, OverflowError, OSError):
         return str(s)
 
+# Claves alternativas que usa Holded, por orden de preferencia
+_NUMBER_KEYS = ("number", "docNumber", "code", "serial", "_id", "id")
+_DATE_KEYS   = ("date", "createdAt", "issuedOn", "updatedAt")
+
+def _first_value(d: dict, keys, default="-"):
+    """Primer valor no vacío de `keys` en `d`."""
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return v
+    return default
+
+def _doc_epoch(d: dict) -> int:
+    """Fecha del documento en epoch segundos (0 si no viene como epoch)."""
+    raw = _first_value(d, _DATE_KEYS, None)
+    try:
+        ts = int(float(raw))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+    if ts >= 10**12:  # milisegundos
+        ts //= 1000
+    return ts
+
 def doc_number(d: dict) -> str:
-    return (
-        d.get("number")
-        or d.get("docNumber")
-        or d.get("code")
-        or d.get("serial")
-        or d.get("_id")
-        or d.get("id")
-        or "-"
-    )
+    return _first_value(d, _NUMBER_KEYS)
+
+def doc_customer(d: dict) -> str:
+    return (d.get("customer") or {}).get("name") or d.get("contactName") or "-"
+
+def doc_date_str(d: dict) -> str:
+    """Fecha del documento para mostrar (hora Madrid si viene como epoch)."""
+    return epoch_to_local_str(_first_value(d, _DATE_KEYS))
+
+class Row(NamedTuple):
+    """Campos de un documento tal y como se muestran en consola y en el email."""
+    number: str
+    customer: str
+    subtotal: float
+    fecha: str
+
+def project(d: dict) -> Row:
+    """Extrae una sola vez los campos a mostrar (get_subtotal puede sumar líneas)."""
+    return Row(doc_number(d), doc_customer(d), get_subtotal(d), doc_date_str(d))
 
 def _mark_doc_type(docs, doc_type):
     """
@@ -144,6 +231,9 @@ def is_credit_note(doc: dict) -> bool:
     return num.startswith("r")
 
 # --- Totales (sin IVA) con signo ---
+# Memo por (docType, id) para las filas de pedidos/nuevos; run_report() lo vacía al empezar
+_SUBTOTAL_CACHE: dict[tuple, float] = {}
+
 def get_subtotal(doc: dict) -> float:
     """
     Obtiene la base imponible (sin IVA) de un documento Holded, conservando el signo.
@@ -151,7 +241,17 @@ def get_subtotal(doc: dict) -> float:
     """
     if not isinstance(doc, dict):
         return 0.0
+    doc_id = doc.get("_id") or doc.get("id")
+    if not doc_id:
+        return _compute_subtotal(doc)
+    key = (doc.get("_docType"), doc_id)
+    base = _SUBTOTAL_CACHE.get(key)
+    if base is None:
+        base = _SUBTOTAL_CACHE[key] = _compute_subtotal(doc)
+    return base
 
+def _compute_subtotal(doc: dict) -> float:
+    """Cálculo real de get_subtotal (sin memo)."""
     candidate_keys = (
         "subtotal", "subTotal", "taxBase", "base", "baseAmount",
         "untaxed", "untaxedAmount", "totalNoTax", "total_without_tax",
@@ -215,45 +315,109 @@ def get_subtotal(doc: dict) -> float:
     return base
 
 # --- Estado facturas ---
+def _write_processed_invoices(ids):
+    """Reescribe el estado completo (migración / compactación)."""
+    STATE_FILE_INVOICES.parent.mkdir(exist_ok=True)
+    STATE_FILE_INVOICES.write_text("".join(f"{i}\n" for i in sorted(map(str, ids))), encoding="utf-8")
+
 def load_processed_invoices():
     if STATE_FILE_INVOICES.exists():
+        lines = [ln for ln in STATE_FILE_INVOICES.read_text(encoding="utf-8").splitlines() if ln]
+        ids = set(lines)
+        if len(ids) != len(lines):  # ids repetidos en el log: se compacta
+            _write_processed_invoices(ids)
+        return ids
+    if LEGACY_STATE_FILE_INVOICES.exists():
         try:
-            return set(json.loads(STATE_FILE_INVOICES.read_text()))
+            ids = set(map(str, _json_loads(LEGACY_STATE_FILE_INVOICES.read_bytes())))
         except Exception:
             return set()
+        _write_processed_invoices(ids)  # migra al formato de texto
+        return ids
     return set()
 
-def save_processed_invoices(ids):
+def save_processed_invoices(new_ids):
+    """Añade al final del archivo solo los ids nuevos (append-only: coste proporcional a lo nuevo)."""
+    if not new_ids:
+        return
     STATE_FILE_INVOICES.parent.mkdir(exist_ok=True)
-    STATE_FILE_INVOICES.write_text(json.dumps(sorted(ids), ensure_ascii=False, indent=2))
+    # Si el archivo se editó a mano sin salto final, el primer id nuevo se pegaría al último
+    sep = ""
+    if STATE_FILE_INVOICES.exists():
+        with STATE_FILE_INVOICES.open("rb") as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                sep = "" if f.read(1) == b"\n" else "\n"
+    with STATE_FILE_INVOICES.open("a", encoding="utf-8") as f:
+        f.write(sep + "".join(f"{i}\n" for i in sorted(map(str, new_ids))))
 
 # --- API genérica por rango ---
+def _fetch_page(base_url, start_s, end_s, page):
+    """Descarga una página del rango. Devuelve lista vacía si no hay más documentos."""
+    params = {"page": page, "limit": PAGE_LIMIT, "starttmp": str(start_s), "endtmp": str(end_s)}
+    r = SESSION.get(base_url, headers=headers(), params=params, timeout=60)
+    if r.status_code == 401:
+        raise SystemExit(f"401 Unauthorized: {r.text}")
+    r.raise_for_status()
+    batch = _json_loads(r.content)
+    if not batch:
+        return []
+    if isinstance(batch, dict):
+        raise SystemExit(f"Respuesta inesperada de API: {batch}")
+    return batch
+
+def iter_range_pages(base_url, start_s, end_s):
+    """
+    Recorre las páginas de un rango (epoch segundos UTC) y las va entregando.
+    La página 1 va sola; si viene llena, las siguientes se piden en bloques de
+    PAGE_WORKERS en paralelo hasta que alguna llega incompleta.
+    """
+    batch = _fetch_page(base_url, start_s, end_s, 1)
+    if batch:
+        yield batch
+    if len(batch) < PAGE_LIMIT:
+        return
+
+    page = 2
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as ex:
+        while True:
+            pages = range(page, page + PAGE_WORKERS)
+            for batch in ex.map(lambda p: _fetch_page(base_url, start_s, end_s, p), pages):
+                if batch:
+                    yield batch
+                if len(batch) < PAGE_LIMIT:
+                    return
+            page += PAGE_WORKERS
+
 def fetch_range(base_url, start_s, end_s):
     """Obtiene documentos en un rango de tiempo (epoch segundos UTC)."""
-    items, page = [], 1
-    while True:
-        params = {"page": page, "limit": PAGE_LIMIT, "starttmp": str(start_s), "endtmp": str(end_s)}
-        r = requests.get(base_url, headers=headers(), params=params, timeout=60)
-        if r.status_code == 401:
-            raise SystemExit(f"401 Unauthorized: {r.text}")
-        r.raise_for_status()
-        batch = r.json()
-        if not batch:
-            break
-        if isinstance(batch, dict):
-            raise SystemExit(f"Respuesta inesperada de API: {batch}")
-        items.extend(batch)
-        if len(batch) < PAGE_LIMIT:
-            break
-        page += 1
-    return items
-
-def fetch_yesterday(base_url):
-    start_s, end_s = madrid_yesterday_bounds_epoch_seconds()
+    return [d for batch in iter_range_pages(base_url, start_s, end_s) for d in batch]
+
+def fetch_range_totals(base_url, doc_type, start_s, end_s, since_s):
+    """
+    Suma bases imponibles (ver subtotal_sum_finalized) página a página, sin guardar los documentos.
+    Devuelve (total del rango, total desde `since_s`): YTD y MTD con una sola descarga.
+    """
+    # Solo se guardan los importes (floats), no los documentos
+    totals, totals_since = [], []
+    for batch in iter_range_pages(base_url, start_s, end_s):
+        _mark_doc_type(batch, doc_type)
+        for inv in batch:
+            if not _counts_in_total(inv):
+                continue
+            # Sin memo: cada documento se calcula una vez y no queda en _SUBTOTAL_CACHE
+            base = _compute_subtotal(inv) if isinstance(inv, dict) else 0.0
+            totals.append(base)
+            if _doc_epoch(inv) >= since_s:
+                totals_since.append(base)
+    return math.fsum(totals), math.fsum(totals_since)
+
+def fetch_yesterday(base_url, now_mad=None):
+    start_s, end_s = madrid_yesterday_bounds_epoch_seconds(now_mad)
     return fetch_range(base_url, start_s, end_s)
 
-def fetch_last_days(base_url, days=10):
-    now_mad = datetime.now(TZ_MADRID)
+def fetch_last_days(base_url, days=10, now_mad=None):
+    now_mad = now_mad or datetime.now(TZ_MADRID)
     start_mad = now_mad - timedelta(days=days)
     start_utc = datetime(start_mad.year, start_mad.month, start_mad.day, 0, 0, 0, tzinfo=TZ_MADRID).astimezone(timezone.utc)
     end_utc   = now_mad.astimezone(timezone.utc)
@@ -261,93 +425,97 @@ def fetch_last_days(base_url, days=10):
     return fetch_range(base_url, start_s, end_s)
 
 # --- Rangos MTD / YTD ---
-def month_bounds_epoch_seconds_now():
-    now_mad = datetime.now(TZ_MADRID)
+# Los helpers de fechas aceptan `now_mad` para que main() use el mismo instante en todo el run
+def month_bounds_epoch_seconds_now(now_mad=None):
+    now_mad = now_mad or datetime.now(TZ_MADRID)
     start_mad = datetime(now_mad.year, now_mad.month, 1, 0, 0, 0, tzinfo=TZ_MADRID)
     end_mad   = now_mad  # hasta ahora
     return int(start_mad.astimezone(timezone.utc).timestamp()), int(end_mad.astimezone(timezone.utc).timestamp())
 
-def year_bounds_epoch_seconds_now():
-    now_mad = datetime.now(TZ_MADRID)
+def year_bounds_epoch_seconds_now(now_mad=None):
+    now_mad = now_mad or datetime.now(TZ_MADRID)
     start_mad = datetime(now_mad.year, 1, 1, 0, 0, 0, tzinfo=TZ_MADRID)
     end_mad   = now_mad  # hasta ahora
     return int(start_mad.astimezone(timezone.utc).timestamp()), int(end_mad.astimezone(timezone.utc).timestamp())
 
 # --- Filtros de estado ---
+_RE_STATUS_DRAFT   = re.compile(r"draft|borrador|temp")
+_RE_STATUS_INVALID = re.compile(r"cancel|anul|void|draft|borrador|temp")
+_INVALID_STATUS_CODES = frozenset((0, 9, 99))  # borrador | anulada/void
+_CANCEL_FLAG_KEYS = ("cancelled", "canceled", "isCanceled", "void", "voided")
+_TRUE_FLAGS = (True, "true", 1, "1")  # tupla: el valor puede no ser hashable
+
+def _raw_status(inv: dict):
+    # Cadena de `or` a propósito: si todas son falsy devuelve la última (p. ej. statusCode 0)
+    return inv.get("status") or inv.get("state") or inv.get("docStatus") or inv.get("statusCode")
+
 def is_invoice_draft(inv: dict) -> bool:
     """Detecta 'borrador' (texto o código 0)."""
-    raw = inv.get("status") or inv.get("state") or inv.get("docStatus") or inv.get("statusCode")
-    txt = _norm_text(raw)
+    raw = _raw_status(inv)
     if isinstance(raw, (int, float)) and int(raw) == 0:
         return True
-    return any(tok in txt for tok in ("draft", "borrador", "temp"))
+    return _RE_STATUS_DRAFT.search(_norm_text(raw)) is not None
 
 def is_invoice_finalized(inv: dict) -> bool:
     """
     Consideramos 'válida' si NO está en borrador ni anulada.
     (Para abonos usamos is_credit_note + is_invoice_draft).
     """
-    raw = inv.get("status") or inv.get("state") or inv.get("docStatus") or inv.get("statusCode")
-    status_txt = _norm_text(raw)
-
-    if any(inv.get(k) in (True, "true", 1, "1") for k in ("cancelled", "canceled", "isCanceled", "void", "voided")):
+    raw = _raw_status(inv)
+    # Código numérico primero: es la comprobación más barata
+    if isinstance(raw, (int, float)) and int(raw) in _INVALID_STATUS_CODES:
         return False
-
-    if isinstance(raw, (int, float)):
-        code = int(raw)
-        if code in (0,):     # borrador
-            return False
-        if code in (9, 99):  # anulada/void
-            return False
-
-    if any(tok in status_txt for tok in ("cancel", "anul", "void")):
+    if any(inv.get(k) in _TRUE_FLAGS for k in _CANCEL_FLAG_KEYS):
         return False
-    if any(tok in status_txt for tok in ("draft", "borrador", "temp")):
-        return False
-    return True
+    return _RE_STATUS_INVALID.search(_norm_text(raw)) is None
 
-def subtotal_sum_finalized(invoices):
+def _counts_in_total(inv) -> bool:
     """
-    Suma bases imponibles con signo.
+    Si el documento entra en los totales:
     - Abonos: se incluyen salvo que estén en borrador.
     - Facturas normales: se incluyen si no están en borrador/anuladas.
     """
-    total = 0.0
-    for inv in invoices:
-        if is_credit_note(inv):
-            if not is_invoice_draft(inv):
-                total += get_subtotal(inv)
-        else:
-            if is_invoice_finalized(inv):
-                total += get_subtotal(inv)
-    return total
+    return not is_invoice_draft(inv) if is_credit_note(inv) else is_invoice_finalized(inv)
+
+def subtotal_sum_finalized(invoices):
+    """Suma bases imponibles con signo de los documentos que cuentan (ver _counts_in_total)."""
+    # fsum: sin deriva de redondeo al acumular miles de importes del año
+    return math.fsum(get_subtotal(inv) for inv in invoices if _counts_in_total(inv))
 
 # --- HTML ---
-def build_html_table(items, date_label, base_sum, titulo, subtitulo):
-    if not items:
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+def _h(x) -> str:
+    """Escapa texto para HTML en una sola pasada (clientes con '&', '<'...)."""
+    return str(x).translate(_HTML_ESCAPE)
+
+_ROW_TPL = (
+    "<tr>"
+    "<td style='white-space:nowrap'>{number}</td>"
+    "<td>{customer}</td>"
+    "<td style='text-align:right'>{subtotal}</td>"
+    "<td style='white-space:nowrap'>{fecha}</td>"
+    "</tr>"
+)
+
+def build_html_table(rows, date_label, base_sum, titulo, subtitulo):
+    """`rows`: lista de Row (ver project)."""
+    if not rows:
         return f"<p>No hay {titulo.lower()} nuevos hasta {date_label}.</p>"
 
-    rows = []
-    for d in items:
-        number   = doc_number(d)
-        customer = (d.get("customer") or {}).get("name") or d.get("contactName") or "-"
-        subtotal = get_subtotal(d)
-        fecha    = d.get("date") or d.get("createdAt") or d.get("issuedOn") or d.get("updatedAt") or "-"
-        fecha_hr = epoch_to_local_str(fecha) if str(fecha).isdigit() else fecha
-        rows.append(
-            f"<tr>"
-            f"<td style='white-space:nowrap'>{number}</td>"
-            f"<td>{customer}</td>"
-            f"<td style='text-align:right'>{fmt_eur(subtotal)}</td>"
-            f"<td style='white-space:nowrap'>{fecha_hr}</td>"
-            f"</tr>"
-        )
-
-    rows_html = "\n".join(rows)
+    rows_html = "\n".join(
+        _ROW_TPL.format_map({
+            "number":   _h(r.number),
+            "customer": _h(r.customer),
+            "subtotal": fmt_eur(r.subtotal),
+            "fecha":    _h(r.fecha),
+        })
+        for r in rows
+    )
     return f"""
     <div style="font-family:system-ui,Segoe UI,Roboto,Arial,sans-serif">
       <h3 style="margin:0 0 8px">{titulo} nuevos — hasta {date_label}</h3>
-      <p style="margin:0 0 12px">Total {subtitulo}: <b>{len(items)}</b> &nbsp;|&nbsp; Base imponible total: <b>{fmt_eur(base_sum)}</b></p>
+      <p style="margin:0 0 12px">Total {subtitulo}: <b>{len(rows)}</b> &nbsp;|&nbsp; Base imponible total: <b>{fmt_eur(base_sum)}</b></p>
       <table border="1" cellspacing="0" cellpadding="6" style="border-collapse:collapse">
         <thead><tr><th>Nº</th><th>Cliente</th><th>Subtotal (sin IVA)</th><th>Fecha</th></tr></thead>
         <tbody>{rows_html}</tbody>
@@ -367,7 +535,8 @@ def build_html_summary_mtd_ytd(mtd_total, ytd_total, mes_nombre):
     """
 
 # --- Email ---
-def send_email(subject, html):
+def _open_smtp():
+    """Abre una conexión SMTP autenticada (465 SSL | 587 STARTTLS). Usar con `with`."""
     missing = [k for k,v in {
         "MAIL_FROM":MAIL_FROM, "MAIL_TO":MAIL_TO, "SMTP_HOST":SMTP_HOST,
         "SMTP_PORT":SMTP_PORT, "SMTP_USER":SMTP_USER, "SMTP_PASS":SMTP_PASS
@@ -375,6 +544,30 @@ def send_email(subject, html):
     if missing:
         raise SystemExit(f"Faltan variables SMTP en entorno: {', '.join(missing)}")
 
+    if SMTP_PORT == 465:
+        context = ssl.create_default_context()
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=60)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=60)
+    try:
+        if SMTP_PORT != 465:
+            server.ehlo()
+            server.starttls()
+            server.ehlo()
+        server.login(SMTP_USER, SMTP_PASS)
+    except smtplib.SMTPAuthenticationError as e:
+        server.close()
+        raise SystemExit(
+            "Autenticación SMTP fallida (535). En Gmail usa una CONTRASEÑA DE APLICACIÓN "
+            "y verifica que MAIL_FROM = SMTP_USER."
+        ) from e
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def _send_on(server, subject, html):
+    """Envía un email HTML sobre una conexión ya abierta con _open_smtp()."""
     msg = MIMEMultipart("alternative")
     msg["Subject"] = subject
     msg["From"] = MAIL_FROM
@@ -382,89 +575,115 @@ def send_email(subject, html):
     msg.attach(MIMEText(html, "html"))
 
     recipients = [e.strip() for e in (MAIL_TO or "").split(",") if e.strip()]
+    # send_message serializa con BytesGenerator: sin copia intermedia as_string() del HTML
+    server.send_message(msg, from_addr=MAIL_FROM, to_addrs=recipients)
 
-    try:
-        if SMTP_PORT == 465:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=60) as server:
-                server.login(SMTP_USER, SMTP_PASS)
-                server.sendmail(MAIL_FROM, recipients, msg.as_string())
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=60) as server:
-                server.ehlo()
-                server.starttls()
-                server.ehlo()
-                server.login(SMTP_USER, SMTP_PASS)
-                server.sendmail(MAIL_FROM, recipients, msg.as_string())
-    except smtplib.SMTPAuthenticationError as e:
-        raise SystemExit(
-            "Autenticación SMTP fallida (535). En Gmail usa una CONTRASEÑA DE APLICACIÓN "
-            "y verifica que MAIL_FROM = SMTP_USER."
-        ) from e
+def send_many(messages):
+    """Envía varios (subject, html) con una única conexión SMTP (un solo TLS + AUTH)."""
+    with _open_smtp() as server:
+        for subject, html in messages:
+            _send_on(server, subject, html)
+
+def send_email(subject, html):
+    send_many([(subject, html)])
 
 # --- Print helper ---
-def print_section(items, date_label, titulo):
-    print(f"{titulo} — hasta {date_label}: {len(items)}\n")
-    base_sum = 0.0
-    for d in items:
-        number   = doc_number(d)
-        customer = (d.get("customer") or {}).get("name") or d.get("contactName") or "-"
-        subtotal = get_subtotal(d)
-        fecha    = d.get("date") or d.get("createdAt") or d.get("issuedOn") or d.get("updatedAt") or "-"
-        fecha_hr = epoch_to_local_str(fecha) if str(fecha).isdigit() else fecha
-        base_sum += subtotal
-        print(f"{number:>12} | {customer} | {fmt_eur(subtotal):>12} | {fecha_hr}")
-    print("\n" + "-"*60)
-    print(f"BASE IMPONIBLE TOTAL: {fmt_eur(base_sum)}")
-    print("-"*60)
+def print_section(rows, date_label, titulo):
+    """`rows`: lista de Row (ver project). Devuelve la base imponible total."""
+    lines = [f"{titulo} — hasta {date_label}: {len(rows)}\n"]
+    lines.extend(f"{r.number:>12} | {r.customer} | {fmt_eur(r.subtotal):>12} | {r.fecha}" for r in rows)
+    base_sum = math.fsum(r.subtotal for r in rows)
+    lines.append("\n" + "-"*60)
+    lines.append(f"BASE IMPONIBLE TOTAL: {fmt_eur(base_sum)}")
+    lines.append("-"*60)
+    # Una sola escritura en vez de un print por fila
+    sys.stdout.write("\n".join(lines) + "\n")
     return base_sum
 
 # --- Main ---
+def _acquire_run_lock():
+    """
+    Bloqueo exclusivo sobre LOCK_FILE para que dos ejecuciones locales solapadas (mismo
+    directorio) no envíen el mismo email ni escriban el estado a la vez. Devuelve None si
+    ya hay otra en curso. En GitHub Actions lo cubre el `concurrency` del workflow.
+    """
+    LOCK_FILE.parent.mkdir(exist_ok=True)
+    lock = open(LOCK_FILE, "w")
+    if fcntl is None:  # Windows: sin bloqueo
+        return lock
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
 def main():
-    date_label = madrid_yesterday_label()
+    lock = _acquire_run_lock()
+    if lock is None:
+        print("Otra ejecución en curso; se omite esta.")
+        return
+    with lock:
+        run_report()
+
+def run_report():
+    _SUBTOTAL_CACHE.clear()  # sin subtotales de una ejecución anterior en el mismo proceso
+    now_mad = datetime.now(TZ_MADRID)
+    date_label = madrid_yesterday_label(now_mad)
+    m_start_s, _ = month_bounds_epoch_seconds_now(now_mad)
+    y_start_s, y_end_s = year_bounds_epoch_seconds_now(now_mad)
+
+    # Las descargas son independientes: se lanzan en paralelo sobre la sesión compartida
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        f_orders          = ex.submit(fetch_yesterday, BASE_URL_ORDERS, now_mad)
+        f_invoices_10d    = ex.submit(fetch_last_days, BASE_URL_INVOICES, 10, now_mad)
+        f_creditnotes_10d = ex.submit(fetch_last_days, BASE_URL_CREDIT_NOTES, 10, now_mad)
+        f_invoices_ytd    = ex.submit(fetch_range_totals, BASE_URL_INVOICES, "invoice", y_start_s, y_end_s, m_start_s)
+        f_creditnotes_ytd = ex.submit(fetch_range_totals, BASE_URL_CREDIT_NOTES, "creditnote", y_start_s, y_end_s, m_start_s)
+
+        orders          = f_orders.result()
+        invoices_10d    = f_invoices_10d.result()
+        creditnotes_10d = f_creditnotes_10d.result()
+        ytd_invoices, mtd_invoices       = f_invoices_ytd.result()
+        ytd_creditnotes, mtd_creditnotes = f_creditnotes_ytd.result()
 
     # Pedidos de AYER
-    orders = fetch_yesterday(BASE_URL_ORDERS)
-    base_orders = print_section(orders, date_label, "Pedidos")
+    order_rows = [project(d) for d in orders]
+    base_orders = print_section(order_rows, date_label, "Pedidos")
 
     # Facturas y abonos "nuevos" (últimos 10 días) — combinados
-    invoices_10d = fetch_last_days(BASE_URL_INVOICES, days=10)
-    creditnotes_10d = fetch_last_days(BASE_URL_CREDIT_NOTES, days=10)
     _mark_doc_type(invoices_10d, "invoice")
     _mark_doc_type(creditnotes_10d, "creditnote")
     docs_10d = invoices_10d + creditnotes_10d
 
     processed_invoices = load_processed_invoices()
-    new_docs = [inv for inv in docs_10d if doc_number(inv) not in processed_invoices]
-    base_invoices = print_section(new_docs, date_label, "Facturas/Abonos NUEVOS")
+    # str(): el estado en texto devuelve ids como cadenas aunque Holded dé el número como int
+    numbered_10d = [(str(doc_number(inv)), inv) for inv in docs_10d]  # se reutiliza al guardar el estado
+    new_docs = [inv for num, inv in numbered_10d if num not in processed_invoices]
+    new_rows = [project(d) for d in new_docs]
+    base_invoices = print_section(new_rows, date_label, "Facturas/Abonos NUEVOS")
 
     # --- Acumulado MTD / YTD (sin IVA) ---
-    m_start_s, m_end_s = month_bounds_epoch_seconds_now()
-    invoices_mtd     = fetch_range(BASE_URL_INVOICES, m_start_s, m_end_s)
-    creditnotes_mtd  = fetch_range(BASE_URL_CREDIT_NOTES, m_start_s, m_end_s)
-    _mark_doc_type(invoices_mtd, "invoice")
-    _mark_doc_type(creditnotes_mtd, "creditnote")
-    mtd_total = subtotal_sum_finalized(invoices_mtd + creditnotes_mtd)
-
-    y_start_s, y_end_s = year_bounds_epoch_seconds_now()
-    invoices_ytd     = fetch_range(BASE_URL_INVOICES, y_start_s, y_end_s)
-    creditnotes_ytd  = fetch_range(BASE_URL_CREDIT_NOTES, y_start_s, y_end_s)
-    _mark_doc_type(invoices_ytd, "invoice")
-    _mark_doc_type(creditnotes_ytd, "creditnote")
-    ytd_total = subtotal_sum_finalized(invoices_ytd + creditnotes_ytd)
+    # El mes en curso está contenido en el año: ambos salen de la misma descarga
+    ytd_total = ytd_invoices + ytd_creditnotes
+    mtd_total = mtd_invoices + mtd_creditnotes
 
     # Print resumen MTD/YTD (sin fechas)
-    now_mad = datetime.now(TZ_MADRID)
     mes_nombre = month_name_es(now_mad)
 
     print("\nFACTURACIÓN ACUMULADA (sin IVA)")
     print(f"Mes en curso ({mes_nombre}): {fmt_eur(mtd_total)}")
     print(f"Año en curso: {fmt_eur(ytd_total)}\n")
 
+    # Sin pedidos ni documentos nuevos: no se construye ni se envía el email
+    if not orders and not new_docs and not SEND_EMPTY:
+        print("Sin pedidos ni facturas/abonos nuevos: no se envía email.")
+        return
+
     # Email
     html_summary = build_html_summary_mtd_ytd(mtd_total, ytd_total, mes_nombre)
-    html_orders   = build_html_table(orders, date_label, base_orders, "Pedidos", "pedidos")
-    html_invoices = build_html_table(new_docs, date_label, base_invoices, "Facturas/Abonos", "documentos")
+    html_orders   = build_html_table(order_rows, date_label, base_orders, "Pedidos", "pedidos")
+    html_invoices = build_html_table(new_rows, date_label, base_invoices, "Facturas/Abonos", "documentos")
 
     html = html_summary + html_orders + "<br><br>" + html_invoices
     subject = f"Total Pedidos y Facturas {date_label}"
@@ -473,8 +692,8 @@ def main():
     print("Email enviado.")
 
     # Guardar estado (por número/código como antes)
-    all_ids = processed_invoices.union(doc_number(inv) for inv in docs_10d)
-    save_processed_invoices(all_ids)
+    new_ids = {num for num, _ in numbered_10d} - processed_invoices
+    save_processed_invoices(new_ids)  # no escribe nada si no hay ids nuevos
 
 if __name__ == "__main__":
     main()